@@ -2442,7 +2442,7 @@ class ResourceAccessListElementSerializer(UserSerializer):
             else:
                 # Singleton roles should not be managed from this view, as per copy/edit rework spec
                 role_dict['user_capabilities'] = {'unattach': False}
-            return {'role': role_dict, 'descendant_roles': get_roles_on_resource(obj, role)}
+            return {'role': role_dict, 'descendant_roles': sorted(get_roles_on_resource(obj, role))}
 
         def format_team_role_perm(naive_team_role, permissive_role_ids):
             ret = []
@@ -2468,7 +2468,7 @@ class ResourceAccessListElementSerializer(UserSerializer):
                 else:
                     # Singleton roles should not be managed from this view, as per copy/edit rework spec
                     role_dict['user_capabilities'] = {'unattach': False}
-                ret.append({'role': role_dict, 'descendant_roles': get_roles_on_resource(obj, team_role)})
+                ret.append({'role': role_dict, 'descendant_roles': sorted(get_roles_on_resource(obj, team_role))})
             return ret
 
         team_content_type = ContentType.objects.get_for_model(Team)
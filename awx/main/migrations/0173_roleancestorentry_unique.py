@@ -0,0 +1,31 @@
+# Generated by Django 3.2.13 on 2026-10-15 12:00
+
+from django.db import migrations
+
+
+def remove_duplicate_ancestors(apps, schema_editor):
+    # Drop any duplicate ancestry entries left behind by concurrent rebuilds, so the constraint can be created
+    if schema_editor.connection.vendor == 'postgresql':
+        sql = (
+            'DELETE FROM main_rbac_role_ancestors a USING main_rbac_role_ancestors b '
+            'WHERE a.descendent_id = b.descendent_id AND a.ancestor_id = b.ancestor_id AND a.id > b.id'
+        )
+    else:
+        sql = 'DELETE FROM main_rbac_role_ancestors WHERE id NOT IN (SELECT MIN(id) FROM main_rbac_role_ancestors GROUP BY descendent_id, ancestor_id)'
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0172_prevent_instance_fallback'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_ancestors, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='roleancestorentry',
+            unique_together={('descendent', 'ancestor')},
+        ),
+    ]
@@ -88,7 +88,7 @@ class ResourceMixin(models.Model):
 
     def get_permissions(self, accessor):
         """
-        Returns a string list of the roles a accessor has for a given resource.
+        Returns the set of role names a accessor has for a given resource.
         An accessor can be either a User, Role, or an arbitrary resource that
         contains one or more Roles associated with it.
         """
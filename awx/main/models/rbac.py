@@ -6,9 +6,12 @@ import logging
 import threading
 import contextlib
 import re
+from functools import lru_cache
+from io import StringIO
 
 # Django
 from django.db import models, transaction, connection
+from django.db.models.signals import post_migrate
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.utils.translation import gettext_lazy as _
@@ -79,6 +82,147 @@ role_descriptions = {
 
 tls = threading.local()  # thread local storage
 
+# Scratch table used by rebuild_role_ancestor_list. The role ids it was handed
+# are shipped to the database once, so the SQL text stays the same no matter
+# how many roles are involved.
+ROLE_REBUILD_IDS_TABLE = '_role_rebuild_ids'
+
+def _create_temporary_table(cursor, table, columns):
+    if connection.vendor == 'postgresql':
+        cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS %s (%s) ON COMMIT DROP' % (table, columns))
+    else:
+        cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS %s (%s)' % (table, columns))
+
+
+def _clear_temporary_table(cursor, table):
+    if connection.vendor == 'postgresql':
+        cursor.execute('TRUNCATE %s' % table)
+    else:
+        cursor.execute('DELETE FROM %s' % table)
+
+
+def _load_role_id_table(cursor, table, role_ids):
+    role_ids = set(role_ids)
+    _clear_temporary_table(cursor, table)
+    if connection.vendor == 'postgresql':
+        cursor.copy_expert('COPY %s (id) FROM STDIN' % table, StringIO('\n'.join(str(x) for x in role_ids)))
+        # autovacuum never analyzes temporary tables, without this the planner
+        # has no idea how many ids it is starting from
+        cursor.execute('ANALYZE %s' % table)
+    else:
+        cursor.executemany('INSERT INTO %s (id) VALUES (%%s)' % table, [(x,) for x in role_ids])
+
+
+_ancestry_rebuild_sql = {}
+
+
+def _get_ancestry_rebuild_sql():
+    """
+    Returns the statements used by Role.rebuild_role_ancestor_list. They only
+    depend on table names and the database vendor, so they are formatted once
+    per process.
+    """
+    if connection.vendor in _ancestry_rebuild_sql:
+        return _ancestry_rebuild_sql[connection.vendor]
+
+    sql_params = {
+        'ancestors_table': Role.ancestors.through._meta.db_table,
+        'parents_table': Role.parents.through._meta.db_table,
+        'roles_table': Role._meta.db_table,
+        'ids_table': ROLE_REBUILD_IDS_TABLE,
+    }
+
+    # Entries that are already stored are skipped by the unique
+    # (descendent, ancestor) constraint rather than by an anti-join
+    if connection.vendor == 'postgresql':
+        sql_params['insert_ignore'] = 'INSERT INTO'
+        sql_params['on_conflict_ignore'] = 'ON CONFLICT (descendent_id, ancestor_id) DO NOTHING'
+    else:
+        sql_params['insert_ignore'] = 'INSERT OR IGNORE INTO'
+        sql_params['on_conflict_ignore'] = ''
+
+    sql_params['affected_cte'] = (
+        '''
+        affected(id) AS (
+              SELECT id FROM %(ids_table)s
+
+               UNION
+
+              SELECT parents.from_role_id
+                FROM %(parents_table)s as parents
+                     INNER JOIN affected
+                             ON (parents.to_role_id = affected.id)
+        )
+        '''
+        % sql_params
+    )
+
+    sql_params['new_ancestry_cte'] = (
+        '''
+        new_ancestry_list(descendent_id, ancestor_id) AS (
+              SELECT id, id FROM affected
+
+               UNION
+
+              SELECT new_ancestry_list.descendent_id,
+                     parents.to_role_id
+                FROM new_ancestry_list
+                     INNER JOIN %(parents_table)s as parents
+                             ON (parents.from_role_id = new_ancestry_list.ancestor_id)
+        )
+        '''
+        % sql_params
+    )
+
+    _ancestry_rebuild_sql[connection.vendor] = {
+        'delete': (
+            '''
+            WITH RECURSIVE %(affected_cte)s, %(new_ancestry_cte)s
+            DELETE FROM %(ancestors_table)s
+             WHERE descendent_id IN (SELECT id FROM affected)
+                   AND NOT EXISTS (
+                       SELECT 1 FROM new_ancestry_list
+                        WHERE new_ancestry_list.descendent_id = %(ancestors_table)s.descendent_id
+                              AND new_ancestry_list.ancestor_id = %(ancestors_table)s.ancestor_id
+                   )
+            '''
+            % sql_params
+        ),
+        'insert': (
+            '''
+            WITH RECURSIVE %(affected_cte)s, %(new_ancestry_cte)s
+            %(insert_ignore)s %(ancestors_table)s (descendent_id, ancestor_id, role_field, content_type_id, object_id)
+            SELECT new_ancestry_list.descendent_id,
+                   new_ancestry_list.ancestor_id,
+                   roles.role_field,
+                   COALESCE(roles.content_type_id, 0),
+                   COALESCE(roles.object_id, 0)
+              FROM new_ancestry_list
+                   INNER JOIN %(roles_table)s as roles
+                           ON (roles.id = new_ancestry_list.descendent_id)
+            %(on_conflict_ignore)s
+            '''
+            % sql_params
+        ),
+    }
+    return _ancestry_rebuild_sql[connection.vendor]
+
+
+@lru_cache(maxsize=256)
+def _content_type_id(model):
+    # Content type ids only change when the content types are recreated
+    # (e.g. after a flush), which is followed by post_migrate, see below.
+    return ContentType.objects.get_for_model(model).id
+
+
+def _clear_content_type_id_cache(**kwargs):
+    # post_migrate is where django recreates content types and clears the
+    # ContentType manager's own cache, so drop ours at the same time.
+    _content_type_id.cache_clear()
+
+
+post_migrate.connect(_clear_content_type_id_cache)
+
 
 def check_singleton(func):
     """
@@ -126,8 +270,9 @@ def batch_role_ancestor_rebuilding(allow_nesting=False):
         if not batch_role_rebuilding:
             additions = getattr(tls, 'additions')
             removals = getattr(tls, 'removals')
-            with transaction.atomic():
-                Role.rebuild_role_ancestor_list(list(additions), list(removals))
+            if additions or removals:
+                with transaction.atomic():
+                    Role.rebuild_role_ancestor_list(list(additions), list(removals))
             delattr(tls, 'additions')
             delattr(tls, 'removals')
 
@@ -163,23 +308,63 @@ class Role(models.Model):
             return u'%s-%s' % (self._meta.verbose_name, self.pk)
 
     def save(self, *args, **kwargs):
+        adding = self._state.adding
         super(Role, self).save(*args, **kwargs)
+        if adding and not getattr(tls, 'batch_role_rebuilding', False):
+            # A brand new role cannot have parents or children yet, so its
+            # only ancestor entry is the self reference.
+            RoleAncestorEntry.objects.create(
+                descendent_id=self.id,
+                ancestor_id=self.id,
+                role_field=self.role_field,
+                content_type_id=self.content_type_id or 0,
+                object_id=self.object_id or 0,
+            )
+            return
         self.rebuild_role_ancestor_list([self.id], [])
 
+    @classmethod
+    def bulk_create_with_rebuild(cls, objs, batch_size=1000):
+        """
+        Creates the given (unsaved) roles and rebuilds their ancestry in a
+        single pass once all of them exist, instead of once per role.
+
+        Roles are inserted with bulk_create where the backend can return
+        their primary keys, so save() is not called and no pre_save or
+        post_save signals are sent for them.
+        """
+        with batch_role_ancestor_rebuilding():
+            if connection.features.can_return_rows_from_bulk_insert:
+                roles = cls.objects.bulk_create(objs, batch_size=batch_size)
+            else:
+                # Without primary keys coming back from the bulk insert we
+                # have to insert one at a time, bypassing Role.save so the
+                # ids are only queued once below.
+                roles = list(objs)
+                for role in roles:
+                    models.Model.save(role)
+            # Only enqueues the ids, the rebuild itself runs once when the
+            # outermost batch_role_ancestor_rebuilding exits.
+            tls.additions.update(role.id for role in roles)
+        return roles
+
     def get_absolute_url(self, request=None):
         return reverse('api:role_detail', kwargs={'pk': self.pk}, request=request)
 
     def __contains__(self, accessor):
-        if type(accessor) == User:
-            return self.ancestors.filter(members=accessor).exists()
-        elif accessor.__class__.__name__ == 'Team':
-            return self.ancestors.filter(pk=accessor.member_role.id).exists()
-        elif type(accessor) == Role:
+        from awx.main.models.organization import Team  # Avoid circular import
+
+        if isinstance(accessor, User):
+            return self.ancestors.filter(members__id=accessor.pk).exists()
+        elif isinstance(accessor, Team):
+            return self.ancestors.filter(pk=accessor.member_role_id).exists()
+        elif isinstance(accessor, Role):
+            if accessor.pk == self.pk:
+                return True
             return self.ancestors.filter(pk=accessor.pk).exists()
         else:
-            accessor_type = ContentType.objects.get_for_model(accessor)
-            roles = Role.objects.filter(content_type__pk=accessor_type.id, object_id=accessor.id)
-            return self.ancestors.filter(pk__in=roles).exists()
+            accessor_type_id = _content_type_id(type(accessor))
+            return self.ancestors.filter(content_type_id=accessor_type_id, object_id=accessor.id).exists()
 
     @property
     def name(self):
@@ -233,58 +418,44 @@ class Role(models.Model):
         # =================================================
         #
         #   When something changes in our role "hierarchy", we need to update
-        #   the `Role.ancestors` mapping to reflect these changes. The basic
-        #   idea, which the code in this method is modeled after, is to do
-        #   this: When a change happens to a role's parents list, we update
-        #   that role's ancestry list, then we recursively update any child
-        #   roles ancestry lists.  Because our role relationships are not
-        #   strictly hierarchical, and can even have loops, this process may
-        #   necessarily visit the same nodes more than once. To handle this
-        #   without having to keep track of what should be updated (again) and
-        #   in what order, we simply use the termination condition of stopping
-        #   when our stored ancestry list matches what our list should be, eg,
-        #   when nothing changes. This can be simply implemented:
-        #
-        #      if actual_ancestors != stored_ancestors:
-        #          for id in actual_ancestors - stored_ancestors:
-        #              self.ancestors.add(id)
-        #          for id in stored_ancestors - actual_ancestors:
-        #              self.ancestors.remove(id)
+        #   the `Role.ancestors` mapping to reflect these changes. Every role
+        #   whose parents changed, along with everything below it, may have
+        #   a different ancestry now. Everything else is untouched. So we
+        #   work out that set of affected roles, compute their ancestry again
+        #   from the parents table and apply the difference.
         #
-        #          for child in self.children.all():
-        #              child.rebuild_role_ancestor_list()
-        #
-        #   However this results in a lot of calls to the database, so the
-        #   optimized implementation below effectively does this same thing,
-        #   but we update all children at once, so effectively we sweep down
-        #   through our hierarchy one layer at a time instead of one node at a
-        #   time. Because of how this method works, we can also start from many
-        #   roots at once and sweep down a large set of roles, which we take
-        #   advantage of when performing bulk operations.
+        #   Because our role relationships are not strictly hierarchical, and
+        #   can even have loops, both of these walks are done with recursive
+        #   queries using UNION, which discards rows that were already found
+        #   and so stops on its own once nothing new turns up. Since we start
+        #   from many roles at once, the same two statements serve bulk
+        #   operations just as well as a single parent being added.
         #
         #
         # SQL Breakdown
         # =============
-        #   We operate under the assumption that our parent's ancestor list is
-        #   correct, thus we can always compute what our ancestor list should
-        #   be by taking the union of our parent's ancestor lists and adding
-        #   our self reference entry where ancestor_id = descendent_id
-        #
-        #   The DELETE query deletes all entries in the ancestor table that
-        #   should no longer be there (as determined by the NOT EXISTS query,
-        #   which checks to see if the ancestor is still an ancestor of one
-        #   or more of our parents)
+        #   The `affected` CTE starts from the role ids we were handed and
+        #   follows the parents table down to every child, grandchild, etc.
+        #   It never needs to look at the roles table itself; ids of roles
+        #   that have since been deleted simply find no parents or children.
         #
-        #   The INSERT query computes the list of what our ancestor maps should
-        #   be, and inserts any missing entries.
+        #   The `new_ancestry_list` CTE starts with the self reference entry
+        #   (ancestor_id = descendent_id) of each affected role and follows
+        #   the parents table up to every parent, grandparent, etc. This is
+        #   what the ancestor entries of the affected roles should be. It only
+        #   carries (descendent_id, ancestor_id) pairs, so UNION compares as
+        #   little as possible; the descendent's role_field, content_type_id
+        #   and object_id are joined on when inserting.
         #
-        #   Once complete, we select all of the children for the roles we are
-        #   working with, this list becomes the new role list we are working
-        #   with.
+        #   Both CTEs are repeated in the DELETE and INSERT statements rather
+        #   than kept in more temporary tables, which would each cost catalog
+        #   churn on every rebuild and go without statistics.
         #
-        #   When our delete or insert query return that they have not performed
-        #   any work, then we know that our children will also not need to be
-        #   updated, and so we can terminate our loop.
+        #   The DELETE query removes stored entries of the affected roles that
+        #   are not in that list, and the INSERT query adds the ones that are
+        #   missing, leaning on the unique (descendent, ancestor) constraint to
+        #   skip those already there. Entries that are still correct are left
+        #   alone, which on a large hierarchy is by far the majority of them.
         #
         #
 
@@ -300,111 +471,14 @@ class Role(models.Model):
             return
 
         cursor = connection.cursor()
-        loop_ct = 0
-
-        sql_params = {
-            'ancestors_table': Role.ancestors.through._meta.db_table,
-            'parents_table': Role.parents.through._meta.db_table,
-            'roles_table': Role._meta.db_table,
-        }
-
-        # SQLlite has a 1M sql statement limit.. since the django sqllite
-        # driver isn't letting us pass in the ids through the preferred
-        # parameter binding system, this function exists to obey this.
-        # est max 12 bytes per number, used up to 2 times in a query,
-        # minus 4k of padding for the other parts of the query, leads us
-        # to the magic number of 41496, or 40000 for a nice round number
-        def split_ids_for_sqlite(role_ids):
-            for i in range(0, len(role_ids), 40000):
-                yield role_ids[i : i + 40000]
+        rebuild_sql = _get_ancestry_rebuild_sql()
 
         with transaction.atomic():
-            while len(additions) > 0 or len(removals) > 0:
-                if loop_ct > 100:
-                    raise Exception('Role ancestry rebuilding error: infinite loop detected')
-                loop_ct += 1
-
-                delete_ct = 0
-                if len(removals) > 0:
-                    for ids in split_ids_for_sqlite(removals):
-                        sql_params['ids'] = ','.join(str(x) for x in ids)
-                        cursor.execute(
-                            '''
-                            DELETE FROM %(ancestors_table)s
-                            WHERE descendent_id IN (%(ids)s)
-                                  AND descendent_id != ancestor_id
-                                  AND NOT EXISTS (
-                                      SELECT 1
-                                        FROM %(parents_table)s as parents
-                                             INNER JOIN %(ancestors_table)s as inner_ancestors
-                                                     ON (parents.to_role_id = inner_ancestors.descendent_id)
-                                       WHERE parents.from_role_id = %(ancestors_table)s.descendent_id
-                                             AND %(ancestors_table)s.ancestor_id = inner_ancestors.ancestor_id
-                                  )
-                        '''
-                            % sql_params
-                        )
-
-                        delete_ct += cursor.rowcount
-
-                insert_ct = 0
-                if len(additions) > 0:
-                    for ids in split_ids_for_sqlite(additions):
-                        sql_params['ids'] = ','.join(str(x) for x in ids)
-                        cursor.execute(
-                            '''
-                            INSERT INTO %(ancestors_table)s (descendent_id, ancestor_id, role_field, content_type_id, object_id)
-                            SELECT from_id, to_id, new_ancestry_list.role_field, new_ancestry_list.content_type_id, new_ancestry_list.object_id FROM  (
-                                  SELECT roles.id from_id,
-                                         ancestors.ancestor_id to_id,
-                                         roles.role_field,
-                                         COALESCE(roles.content_type_id, 0) content_type_id,
-                                         COALESCE(roles.object_id, 0) object_id
-                                    FROM %(roles_table)s as roles
-                                         INNER JOIN %(parents_table)s as parents
-                                                 ON (parents.from_role_id = roles.id)
-                                         INNER JOIN %(ancestors_table)s as ancestors
-                                                 ON (parents.to_role_id = ancestors.descendent_id)
-                                   WHERE roles.id IN (%(ids)s)
-
-                                   UNION
-
-                                  SELECT id from_id,
-                                         id to_id,
-                                         role_field,
-                                         COALESCE(content_type_id, 0) content_type_id,
-                                         COALESCE(object_id, 0) object_id
-                                   from %(roles_table)s WHERE id IN (%(ids)s)
-                             ) new_ancestry_list
-                             WHERE NOT EXISTS (
-                                SELECT 1 FROM %(ancestors_table)s
-                                 WHERE %(ancestors_table)s.descendent_id = new_ancestry_list.from_id
-                                       AND %(ancestors_table)s.ancestor_id = new_ancestry_list.to_id
-                             )
-
-                        '''
-                            % sql_params
-                        )
-                        insert_ct += cursor.rowcount
-
-                if insert_ct == 0 and delete_ct == 0:
-                    break
-
-                new_additions = set()
-                for ids in split_ids_for_sqlite(additions):
-                    sql_params['ids'] = ','.join(str(x) for x in ids)
-                    # get all children for the roles we're operating on
-                    cursor.execute('SELECT DISTINCT from_role_id FROM %(parents_table)s WHERE to_role_id IN (%(ids)s)' % sql_params)
-                    new_additions.update([row[0] for row in cursor.fetchall()])
-                additions = list(new_additions)
-
-                new_removals = set()
-                for ids in split_ids_for_sqlite(removals):
-                    sql_params['ids'] = ','.join(str(x) for x in ids)
-                    # get all children for the roles we're operating on
-                    cursor.execute('SELECT DISTINCT from_role_id FROM %(parents_table)s WHERE to_role_id IN (%(ids)s)' % sql_params)
-                    new_removals.update([row[0] for row in cursor.fetchall()])
-                removals = list(new_removals)
+            _create_temporary_table(cursor, ROLE_REBUILD_IDS_TABLE, 'id integer PRIMARY KEY')
+            _load_role_id_table(cursor, ROLE_REBUILD_IDS_TABLE, list(additions) + list(removals))
+
+            cursor.execute(rebuild_sql['delete'])
+            cursor.execute(rebuild_sql['insert'])
 
     @staticmethod
     def visible_roles(user):
@@ -450,8 +524,9 @@ class RoleAncestorEntry(models.Model):
         index_together = [
             ("ancestor", "content_type_id", "object_id"),  # used by get_roles_on_resource
             ("ancestor", "content_type_id", "role_field"),  # used by accessible_objects
-            ("ancestor", "descendent"),  # used by rebuild_role_ancestor_list in the NOT EXISTS clauses.
+            ("ancestor", "descendent"),  # used by filter_visible_roles to list descendents by ancestor
         ]
+        unique_together = [("descendent", "ancestor")]  # also indexes rebuild_role_ancestor_list lookups by descendent
 
     descendent = models.ForeignKey(Role, null=False, on_delete=models.CASCADE, related_name='+')
     ancestor = models.ForeignKey(Role, null=False, on_delete=models.CASCADE, related_name='+')
@@ -462,27 +537,23 @@ class RoleAncestorEntry(models.Model):
 
 def get_roles_on_resource(resource, accessor):
     """
-    Returns a string list of the roles a accessor has for a given resource.
+    Returns the set of role names a accessor has for a given resource.
     An accessor can be either a User, Role, or an arbitrary resource that
     contains one or more Roles associated with it.
     """
 
     if type(accessor) == User:
-        roles = accessor.roles.all()
+        role_ids = list(accessor.roles.values_list('id', flat=True))
     elif type(accessor) == Role:
-        roles = [accessor]
+        role_ids = [accessor.id]
     else:
-        accessor_type = ContentType.objects.get_for_model(accessor)
-        roles = Role.objects.filter(content_type__pk=accessor_type.id, object_id=accessor.id)
+        accessor_type_id = _content_type_id(type(accessor))
+        role_ids = list(Role.objects.filter(content_type_id=accessor_type_id, object_id=accessor.id).values_list('id', flat=True))
 
-    return [
-        role_field
-        for role_field in RoleAncestorEntry.objects.filter(
-            ancestor__in=roles, content_type_id=ContentType.objects.get_for_model(resource).id, object_id=resource.id
-        )
-        .values_list('role_field', flat=True)
-        .distinct()
-    ]
+    resource_type_id = _content_type_id(type(resource))
+    return set(
+        RoleAncestorEntry.objects.filter(ancestor_id__in=role_ids, content_type_id=resource_type_id, object_id=resource.id).values_list('role_field', flat=True)
+    )
 
 
 def role_summary_fields_generator(content_object, role_field):
@@ -19,6 +19,13 @@ def test_rbac_batch_rebuilding(rando, organization):
     assert rando in inventory.admin_role
 
 
+@pytest.mark.django_db
+def test_rbac_batch_rebuilding_nothing_queued(django_assert_num_queries):
+    with django_assert_num_queries(0):
+        with batch_role_ancestor_rebuilding():
+            pass
+
+
 @pytest.mark.django_db
 def test_disable_activity_stream():
     with disable_activity_stream():
@@ -4,7 +4,9 @@ from awx.main.models import (
     Role,
     Organization,
     Project,
+    get_roles_on_resource,
 )
+from awx.main.models.rbac import _content_type_id, _clear_content_type_id_cache
 from awx.main.fields import update_role_parentage_for_instance
 
 
@@ -211,3 +213,24 @@ def test_update_parents_keeps_teams(team, project):
     assert team.member_role in project.update_role  # test prep sanity check
     update_role_parentage_for_instance(project)
     assert team.member_role in project.update_role  # actual assertion
+
+
+@pytest.mark.django_db
+def test_roles_on_resource(organization, inventory, team, alice):
+    organization.admin_role.members.add(alice)
+    team.member_role.children.add(inventory.use_role)
+    assert 'admin_role' in get_roles_on_resource(inventory, alice)
+    assert 'admin_role' in get_roles_on_resource(inventory, organization.admin_role)
+    assert 'admin_role' in get_roles_on_resource(inventory, organization)
+    assert 'use_role' in get_roles_on_resource(inventory, team)
+    assert 'admin_role' not in get_roles_on_resource(inventory, team)
+    assert organization in inventory.admin_role
+    assert inventory not in organization.admin_role
+
+
+@pytest.mark.django_db
+def test_content_type_id_cache_cleared(organization):
+    _content_type_id(Organization)
+    assert _content_type_id.cache_info().currsize > 0
+    _clear_content_type_id_cache()
+    assert _content_type_id.cache_info().currsize == 0
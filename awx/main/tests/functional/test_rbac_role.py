@@ -1,5 +1,7 @@
 import pytest
 
+from django.db import transaction
+
 from awx.main.access import (
     RoleAccess,
     UserAccess,
@@ -192,3 +194,94 @@ def test_orphaned_user_allowed(org_admin, rando, organization, org_credential):
     # Cannot edit the user directly without adding to org first
     user_access = UserAccess(org_admin)
     assert not user_access.can_change(rando, {'last_name': 'Witzel'})
+
+
+@pytest.mark.django_db
+def test_rebuild_additions_sweep_multiple_levels():
+    A, B, C, D = [Role.objects.create() for i in range(4)]
+    D.parents.add(C)
+    C.parents.add(B)
+    B.parents.add(A)
+    assert set(D.ancestors.all()) == {A, B, C, D}
+    assert set(C.ancestors.all()) == {A, B, C}
+
+
+@pytest.mark.django_db
+def test_rebuild_removals_sweep_multiple_levels():
+    A, B, C, D = [Role.objects.create() for i in range(4)]
+    D.parents.add(C)
+    C.parents.add(B)
+    B.parents.add(A)
+    B.parents.remove(A)
+    assert set(B.ancestors.all()) == {B}
+    assert set(D.ancestors.all()) == {B, C, D}
+
+
+@pytest.mark.django_db
+def test_rebuild_twice_in_one_transaction():
+    A, B, C = [Role.objects.create() for i in range(3)]
+    through = Role.parents.through
+    with transaction.atomic():
+        through.objects.create(from_role_id=B.id, to_role_id=A.id)
+        Role.rebuild_role_ancestor_list([B.id], [])
+        through.objects.create(from_role_id=C.id, to_role_id=B.id)
+        Role.rebuild_role_ancestor_list([C.id], [])
+    assert set(C.ancestors.all()) == {A, B, C}
+
+
+@pytest.mark.django_db
+def test_rebuild_many_role_ids():
+    parent = Role.objects.create()
+    children = [Role.objects.create() for i in range(50)]
+    Role.parents.through.objects.bulk_create([Role.parents.through(from_role_id=child.id, to_role_id=parent.id) for child in children])
+    child_ids = [child.id for child in children]
+    # duplicate ids must be tolerated when loading the id table
+    Role.rebuild_role_ancestor_list(child_ids + child_ids, [])
+    for child in children:
+        assert set(child.ancestors.all()) == {parent, child}
+
+
+@pytest.mark.django_db
+def test_role_bulk_create_with_rebuild():
+    roles = Role.bulk_create_with_rebuild([Role(role_field='admin_role') for i in range(3)])
+    assert len(roles) == 3
+    for role in roles:
+        assert list(role.ancestors.all()) == [role]
+
+
+@pytest.mark.django_db
+def test_role_bulk_create_with_rebuild_single_pass(mocker):
+    rebuild = mocker.patch.object(Role, 'rebuild_role_ancestor_list')
+    roles = Role.bulk_create_with_rebuild([Role(role_field='admin_role') for i in range(3)])
+    rebuild.assert_called_once()
+    additions, removals = rebuild.call_args[0]
+    assert sorted(additions) == sorted(role.id for role in roles)
+    assert removals == []
+
+
+@pytest.mark.django_db
+def test_rebuild_removal_from_loop():
+    A, B, C = [Role.objects.create() for i in range(3)]
+    B.parents.add(A)
+    A.parents.add(B)
+    C.parents.add(B)
+    assert set(C.ancestors.all()) == {A, B, C}
+    B.parents.remove(A)
+    assert set(B.ancestors.all()) == {B}
+    assert set(A.ancestors.all()) == {A, B}
+    assert set(C.ancestors.all()) == {B, C}
+
+
+@pytest.mark.django_db
+def test_role_create_skips_rebuild(mocker):
+    rebuild = mocker.patch.object(Role, 'rebuild_role_ancestor_list')
+    role = Role.objects.create(role_field='admin_role')
+    rebuild.assert_not_called()
+    assert list(role.ancestors.all()) == [role]
+
+
+@pytest.mark.django_db
+def test_role_contains_itself_without_query(django_assert_num_queries):
+    role = Role.objects.create()
+    with django_assert_num_queries(0):
+        assert role in role